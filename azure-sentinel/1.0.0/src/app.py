@@ -1,17 +1,102 @@
-import socket
 import asyncio
 import time
 import json
+import functools
+import hashlib
+import random
 import uuid
+import weakref
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from walkoff_app_sdk.app_base import AppBase
 
+# Refresh access tokens this many seconds before Azure AD expires them
+TOKEN_EXPIRY_BUFFER = 300
+# Maximum number of entity/comment lookups in flight at once
+ENRICHMENT_CONCURRENCY = 8
+# Throttled (429) and transient server errors are retried up to MAX_RETRIES times.
+# Without Retry-After the backoff is 1+2+4+8s, about 15s per request, and a
+# Retry-After is capped at MAX_RETRY_DELAY, so one request waits at most ~2 minutes.
+# During fan-out this wait holds one of the ENRICHMENT_CONCURRENCY slots.
+MAX_RETRIES = 4
+MAX_RETRY_DELAY = 30
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Management API calls succeed with 200, or 201 when a resource such as a comment is created
+SUCCESS_STATUSES = (200, 201)
+
+WORKSPACE_URL = (
+    "{azure_url}/subscriptions/{subscription_id}/resourceGroups/{resource_group_name}"
+    "/providers/Microsoft.OperationalInsights/workspaces/{workspace_name}"
+    "/providers/Microsoft.SecurityInsights"
+)
+API_PARAMS = {"api-version": "2020-01-01"}
+ENTITIES_API_PARAMS = {"api-version": "2019-01-01-preview"}
+AUTH_HEADERS = {
+    "Content-Type": "application/x-www-form-urlencoded",
+    "cache-control": "no-cache",
+}
+STATUS_FILTER = "properties/status eq '%s'"
+
+
+def load_json(res):
+    """Parse a JSON response body. Single entry point for response parsing"""
+    return json.loads(res.content)
+
+
+def api_error(res):
+    """Error result for a failed API call, keeping the JSON error body if there is one"""
+    try:
+        error = load_json(res)
+    except ValueError:
+        error = res.text
+    return {"success": False, "status_code": res.status_code, "error": error}
+
+
+def parse_incident_body(body, incident_id=None):
+    """
+    Return the incident dict from a get_incident result (dict or JSON string),
+    or None if it is not a single incident matching incident_id.
+    """
+    if isinstance(body, str):
+        try:
+            body = json.loads(body)
+        except json.JSONDecodeError:
+            return None
+
+    if not isinstance(body, dict) or not isinstance(body.get("properties"), dict):
+        return None
+    if not body.get("name") or (incident_id and body["name"] != incident_id):
+        return None
+
+    return body
+
+
+def mark_success(res):
+    """
+    Add "success": true to a JSON object response by splicing it into the raw
+    body, avoiding a full parse and re-serialise of the object.
+    """
+    body = res.content.strip()
+    if body[:1] != b"{":
+        return json.dumps({"success": True, "result": load_json(res)})
+
+    rest = body[1:].lstrip()
+    separator = b"" if rest[:1] == b"}" else b","
+    return (b'{"success":true' + separator + rest).decode()
+
 
 class AzureSentinel(AppBase):
     __version__ = "1.0.0"
     app_name = "Azure Sentinel"
 
+    # Access tokens shared across invocations: sha256(credentials) -> (token, expires_at)
+    _token_cache = {}
+    # Invocations run in separate event loops, and an asyncio.Lock is bound to
+    # the loop it is first contended in, so keep one lock per running loop
+    _token_locks = weakref.WeakKeyDictionary()
+
     def __init__(self, redis, logger, console_logger=None):
         """
         Each app should have this __init__ to set up Redis and logging.
@@ -21,123 +106,289 @@ class AzureSentinel(AppBase):
         """
         super().__init__(redis, logger, console_logger)
         self.azure_url = "https://management.azure.com"
+        self._auth_args = None
+        self._auth_headers = None
+        self._token_key = None
+
+        # Reuse one pooled session so keep-alive connections survive between calls
+        self.s = requests.Session()
+        self.s.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=32,
+                # Connection errors only, status codes are retried in _send
+                max_retries=Retry(total=3, backoff_factor=0.3),
+            ),
+        )
 
     async def authenticate(self, tenant_id, client_id, client_secret):
 
-        self.s = requests.Session()
-        auth_url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
-        auth_data = {
-            "grant_type": "client_credentials",
-            "client_id": client_id,
-            "client_secret": client_secret,
-            "scope": f"{self.azure_url}/.default",
-        }
-        auth_headers = {
-            "Content-Type": "application/x-www-form-urlencoded",
+        scope = f"{self.azure_url}/.default"
+        self._auth_args = (tenant_id, client_id, client_secret)
+        self._token_key = hashlib.sha256(
+            f"{tenant_id}|{client_id}|{client_secret}|{scope}".encode()
+        ).hexdigest()
+
+        loop = asyncio.get_running_loop()
+        lock = AzureSentinel._token_locks.get(loop)
+        if lock is None:
+            lock = AzureSentinel._token_locks[loop] = asyncio.Lock()
+
+        async with lock:
+            cached = AzureSentinel._token_cache.get(self._token_key)
+            if cached and time.monotonic() < cached[1]:
+                self._auth_headers = {
+                    "Authorization": f"Bearer {cached[0]}",
+                    "cache-control": "no-cache",
+                }
+                return {"success": True, "message": "Using cached access token"}
+
+            auth_url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
+            auth_data = {
+                "grant_type": "client_credentials",
+                "client_id": client_id,
+                "client_secret": client_secret,
+                "scope": scope,
+            }
+
+            self.logger.debug("Making request to: %s", auth_url)
+            res = await self._send("POST", auth_url, data=auth_data, headers=AUTH_HEADERS)
+
+            if res.status_code != 200:
+                self.logger.error("Authentication error has occurred: %s", res.text)
+                return {"success": False, "message": res.text}
+
+            token = load_json(res)
+            access_token = token.get("access_token")
+            if not access_token:
+                self.logger.error("Authentication response has no access token")
+                return {"success": False, "message": "No access token in authentication response"}
+
+            expires_at = time.monotonic() + int(token.get("expires_in", 3600)) - TOKEN_EXPIRY_BUFFER
+            AzureSentinel._token_cache[self._token_key] = (access_token, expires_at)
+
+        self._auth_headers = {
+            "Authorization": f"Bearer {access_token}",
             "cache-control": "no-cache",
         }
+        return {"success": True, "message": res.text}
 
-        self.logger.debug(f"Making request to: {auth_url}")
-        res = self.s.post(auth_url, data=auth_data, headers=auth_headers)
+    async def _ensure_auth(self, tenant_id, client_id, client_secret, **kwargs):
+        """
+        Only authenticate when the session holds no valid token for these
+        credentials. Extra action kwargs are accepted and ignored.
+        """
+        same_creds = self._auth_args == (tenant_id, client_id, client_secret)
+        if same_creds and self._auth_headers:
+            cached = AzureSentinel._token_cache.get(self._token_key)
+            if cached and time.monotonic() < cached[1]:
+                return {"success": True, "message": "Using cached access token"}
 
-        if res.status_code != 200:
-            self.logger.error("Authentication error has occurred: ", res.json())
-            return {"success": False, "message": res.text}
+        return await self.authenticate(tenant_id, client_id, client_secret)
 
-        access_token = res.json().get("access_token")
-        self.s.headers = {"Authorization": f"Bearer {access_token}", "cache-control": "no-cache"}
-        return {"success": True, "message": res.text}
+    async def _send(self, method, url, **kwargs):
+        """
+        Run a request on the shared session in the default executor. requests
+        is blocking, so this keeps the event loop free while calls are in flight.
+        Throttling and transient server errors are retried with exponential
+        backoff and jitter, honouring Retry-After when Azure sends it.
+        """
+        loop = asyncio.get_running_loop()
+        send = functools.partial(self.s.request, method, url, **kwargs)
+
+        for attempt in range(MAX_RETRIES + 1):
+            res = await loop.run_in_executor(None, send)
+            if res.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                return res
+
+            try:
+                delay = float(res.headers["Retry-After"])
+            except (KeyError, ValueError):
+                delay = 2 ** attempt
+
+            delay = min(delay, MAX_RETRY_DELAY) + random.uniform(0, 0.5)
+            self.logger.info(
+                "Got %d from %s, retrying in %.1fs", res.status_code, url, delay
+            )
+            await asyncio.sleep(delay)
+
+    async def _call(self, method, url, **kwargs):
+        """
+        Send an authenticated request on the shared session. The token is
+        passed per request rather than stored on the session, so a token
+        refresh never races with requests already running in the executor.
+        On a 401 the cached token is evicted and the request is retried once.
+        """
+        headers = self._auth_headers
+        res = await self._send(method, url, headers=headers, **kwargs)
+        if res.status_code == 401 and self._token_key:
+            self.logger.info("Access token rejected, re-authenticating")
+            # Only evict the token that was rejected. A concurrent request may
+            # already have replaced it with a fresh one, which should be reused.
+            cached = AzureSentinel._token_cache.get(self._token_key)
+            if cached and headers and headers["Authorization"] == f"Bearer {cached[0]}":
+                del AzureSentinel._token_cache[self._token_key]
+
+            auth = await self.authenticate(*self._auth_args)
+            if auth["success"]:
+                res = await self._send(method, url, headers=self._auth_headers, **kwargs)
+
+        return res
+
+    def _workspace_url(self, kwargs):
+        return WORKSPACE_URL.format(
+            azure_url=self.azure_url,
+            subscription_id=kwargs["subscription_id"],
+            resource_group_name=kwargs["resource_group_name"],
+            workspace_name=kwargs["workspace_name"],
+        )
+
+    async def _paginate(self, url, params):
+        """
+        Yield (response, page) for each page of a list endpoint, following
+        nextLink. The next page is requested before the current one is handed
+        to the caller. page is None when the request failed.
+        """
+        pending = asyncio.create_task(self._call("GET", url, params=params))
+        try:
+            while pending:
+                res = await pending
+                pending = None
+                if res.status_code not in SUCCESS_STATUSES:
+                    yield res, None
+                    return
+
+                page = load_json(res)
+                next_link = page.get("nextLink")
+                if next_link:
+                    pending = asyncio.create_task(self._call("GET", next_link))
+                yield res, page
+        finally:
+            # The caller stopped early or failed, drop the prefetched page
+            if pending:
+                pending.cancel()
 
     async def extract_entities(self, incident_uri):
 
         entities_url = f"{self.azure_url}{incident_uri}/entities"
-        params = {"api-version": "2019-01-01-preview"}
-        self.logger.debug(f"Making request to: {entities_url}")
-        res = self.s.post(entities_url, params=params)
-        if res.status_code != 200:
-            self.logger.error(f"Failed to get entities for {incident_uri}")
+        self.logger.debug("Making request to: %s", entities_url)
+        res = await self._call("POST", entities_url, params=ENTITIES_API_PARAMS)
+        if res.status_code not in SUCCESS_STATUSES:
+            self.logger.error("Failed to get entities for %s", incident_uri)
+            return []
 
-        return res.json().get("entities", [])
+        return load_json(res).get("entities", [])
 
     async def extract_comments(self, incident_uri):
 
         comments_url = f"{self.azure_url}{incident_uri}/comments"
-        params = {"api-version": "2020-01-01"}
-        self.logger.debug(f"Making request to: {comments_url}")
-        res = self.s.get(comments_url, params=params)
-        if res.status_code != 200:
-            self.logger.error(f"Failed to get comments for {incident_uri}")
+        self.logger.debug("Making request to: %s", comments_url)
+        res = await self._call("GET", comments_url, params=API_PARAMS)
+        if res.status_code not in SUCCESS_STATUSES:
+            self.logger.error("Failed to get comments for %s", incident_uri)
+            return []
 
-        return res.json().get("value", [])
+        return load_json(res).get("value", [])
 
     async def get_incidents(self, **kwargs):
 
         # Get a client credential access token
-        auth = await self.authenticate(
-            kwargs["tenant_id"], kwargs["client_id"], kwargs["client_secret"]
-        )
+        auth = await self._ensure_auth(**kwargs)
         if not auth["success"]:
-            return {"error": auth["message"]}
+            return json.dumps({"success": False, "error": auth["message"]})
 
-        incidents_url = f"{self.azure_url}/subscriptions/{kwargs['subscription_id']}/resourceGroups/{kwargs['resource_group_name']}/providers/Microsoft.OperationalInsights/workspaces/{kwargs['workspace_name']}/providers/Microsoft.SecurityInsights/incidents"
-        params = {"api-version": "2020-01-01"}
+        incidents_url = f"{self._workspace_url(kwargs)}/incidents"
+        params = dict(API_PARAMS)
 
         # Add query filters if defined
-        query_filter = ""
-        if kwargs["status"]:
-            status_filters = [
-                f"properties/status eq '{x.strip()}'" for x in kwargs["status"].split(",")
-            ]
-            query_filter = f"( {' or '.join(status_filters)} )"
-            self.logger.debug(f"Adding query filter for status: {query_filter}")
-
-        if kwargs["last_modified"]:
-            status_filters = [
-                f"properties/status eq '{x.strip()}'" for x in kwargs["status"].split(",")
-            ]
-            query_filter = f"{query_filter} and (properties/lastModifiedTimeUtc ge {kwargs['last_modified']}Z)"
-            self.logger.debug(f"Adding query filter for last_modified: {query_filter}")
-
-        if query_filter:
-            params["$filter"] = query_filter
-
-        self.logger.info(f"Making request to: {incidents_url}")
-        res = self.s.get(incidents_url, params=params)
-        if res.status_code != 200:
-            return res.text
-        incidents = res.json()["value"]
-
-        # Get incident entities
-        if kwargs.get("get_entities", "").lower() == "true":
-            for incident in incidents:
-                self.logger.warning(f"Getting entities for {incident['id']}")
-                incident["entities"] = await self.extract_entities(incident["id"])
-
-        # Get incident comments
-        if kwargs.get("get_comments", "").lower() == "true":
-            for incident in incidents:
-                self.logger.warning(f"Getting entities for {incident['id']}")
-                incident["comments"] = await self.extract_comments(incident["id"])
+        filter_parts = []
+        if kwargs.get("status"):
+            statuses = map(str.strip, kwargs["status"].split(","))
+            filter_parts.append("(" + " or ".join(map(STATUS_FILTER.__mod__, statuses)) + ")")
+
+        if kwargs.get("last_modified"):
+            filter_parts.append(f"(properties/lastModifiedTimeUtc ge {kwargs['last_modified']}Z)")
+
+        if filter_parts:
+            params["$filter"] = " and ".join(filter_parts)
+            self.logger.debug("Adding query filter: %s", params["$filter"])
+
+        # Enrich each page with entities and comments while the next page downloads
+        semaphore = asyncio.Semaphore(ENRICHMENT_CONCURRENCY)
+        # (key, incident id) -> lookup task, kept so unfinished lookups can be cancelled
+        lookups = {}
+
+        async def fetch(key, extract, incident_id):
+            async with semaphore:
+                self.logger.debug("Getting %s for %s", key, incident_id)
+                return await extract(incident_id)
+
+        async def enrich(incident, key, extract):
+            lookup = lookups.get((key, incident["id"]))
+            if lookup is None:
+                lookup = asyncio.create_task(fetch(key, extract, incident["id"]))
+                lookups[(key, incident["id"])] = lookup
+            incident[key] = await lookup
+
+        get_entities = kwargs.get("get_entities", "").lower() == "true"
+        get_comments = kwargs.get("get_comments", "").lower() == "true"
+
+        self.logger.info("Making request to: %s", incidents_url)
+        incidents = []
+        seen_ids = set()
+        pages = self._paginate(incidents_url, params)
+        try:
+            async for res, page in pages:
+                if page is None:
+                    return json.dumps(api_error(res))
+
+                # Pages can overlap when incidents change while paging, keep the first copy
+                new_incidents = []
+                for incident in page["value"]:
+                    if incident["id"] not in seen_ids:
+                        seen_ids.add(incident["id"])
+                        new_incidents.append(incident)
+
+                tasks = []
+                if get_entities:
+                    tasks.extend(enrich(x, "entities", self.extract_entities) for x in new_incidents)
+                if get_comments:
+                    tasks.extend(enrich(x, "comments", self.extract_comments) for x in new_incidents)
+
+                await asyncio.gather(*tasks)
+                incidents.extend(new_incidents)
+        finally:
+            # Close the generator so its prefetch is cancelled, and stop any
+            # lookups still running if a page failed part way through
+            await pages.aclose()
+            for lookup in lookups.values():
+                lookup.cancel()
+
+        if get_entities or get_comments:
+            self.logger.info("Enriched %d incidents with %d lookups", len(incidents), len(lookups))
 
         return json.dumps(incidents)
 
-    async def get_incident(self, **kwargs):
-
+    async def _get_incident(self, **kwargs):
+        """
+        Fetch an incident as a dict. Failures are returned as a dict with
+        "success": False and an "error" key.
+        """
         if not kwargs.get("incident_id"):
-            return '{"success": false, "error": "No incident ID supplied"}'
+            return {"success": False, "error": "No incident ID supplied"}
 
         # Get a client credential access token
-        auth = await self.authenticate(
-            kwargs["tenant_id"], kwargs["client_id"], kwargs["client_secret"]
-        )
+        auth = await self._ensure_auth(**kwargs)
+        if not auth["success"]:
+            return {"success": False, "error": auth["message"]}
 
-        incident_url = f"{self.azure_url}/subscriptions/{kwargs['subscription_id']}/resourceGroups/{kwargs['resource_group_name']}/providers/Microsoft.OperationalInsights/workspaces/{kwargs['workspace_name']}/providers/Microsoft.SecurityInsights/incidents/{kwargs['incident_id']}"
-        params = {"api-version": "2020-01-01"}
+        incident_url = f"{self._workspace_url(kwargs)}/incidents/{kwargs['incident_id']}"
 
-        res = self.s.get(incident_url, params=params)
-        if res.status_code != 200:
-            return res.text
-        incident = res.json()
+        res = await self._call("GET", incident_url, params=API_PARAMS)
+        if res.status_code not in SUCCESS_STATUSES:
+            return api_error(res)
+        incident = load_json(res)
 
         # Get incident entities
         if kwargs.get("get_entities", "").lower() == "true":
@@ -147,65 +398,79 @@ class AzureSentinel(AppBase):
         if kwargs.get("get_comments", "").lower() == "true":
             incident["comments"] = await self.extract_comments(incident["id"])
 
-        return json.dumps(incident)
-
-    async def close_incident(self, **kwargs):
+        return incident
 
-        incident = json.loads(await self.get_incident(**kwargs))
-        if "error" in incident:
-            return json.dumps(incident)
+    async def get_incident(self, **kwargs):
 
-        # Get classification and classificationReason
-        close_reason = [x.strip() for x in kwargs["close_reason"].split("-")]
+        return json.dumps(await self._get_incident(**kwargs))
 
-        close_data = {
-            "etag": incident.get("etag", "").strip('"'),
-            "properties": {
-                "title": incident["properties"]["title"],
-                "status": "Closed",
-                "severity": incident["properties"]["severity"],
-                "classification": close_reason[0],
-                "classificationComment": kwargs["close_comment"],
-            },
-        }
-        if len(close_reason) > 1:
-            close_data["properties"]["classificationReason"] = close_reason[1]
+    async def close_incident(self, **kwargs):
 
-        incident_url = f"{self.azure_url}/subscriptions/{kwargs['subscription_id']}/resourceGroups/{kwargs['resource_group_name']}/providers/Microsoft.OperationalInsights/workspaces/{kwargs['workspace_name']}/providers/Microsoft.SecurityInsights/incidents/{kwargs['incident_id']}"
-        params = {"api-version": "2020-01-01"}
+        # Reuse the incident from a previous get_incident call if supplied
+        incident = parse_incident_body(kwargs.get("incident_body"), kwargs.get("incident_id"))
+        if kwargs.get("incident_body") and not incident:
+            self.logger.warning("Ignoring incident_body that is not a matching incident")
 
-        res = self.s.put(incident_url, json=close_data, params=params)
-        if res.status_code != 200:
-            return res.text
+        if not incident and not kwargs.get("incident_id"):
+            return '{"success": false, "error": "No incident ID supplied"}'
 
-        result = res.json()
-        result["success"] = True
+        if incident:
+            kwargs["incident_id"] = incident["name"]
+            auth = await self._ensure_auth(**kwargs)
+            if not auth["success"]:
+                return json.dumps({"success": False, "error": auth["message"]})
 
-        return json.dumps(result)
+        # Get classification and classificationReason
+        close_reason = [x.strip() for x in kwargs["close_reason"].split("-")]
+        incident_url = f"{self._workspace_url(kwargs)}/incidents/{kwargs['incident_id']}"
+
+        for _ in range(2):
+            if not incident:
+                incident = await self._get_incident(**kwargs)
+                if "error" in incident:
+                    return json.dumps(incident)
+
+            close_data = {
+                "etag": incident.get("etag", "").strip('"'),
+                "properties": {
+                    "title": incident["properties"]["title"],
+                    "status": "Closed",
+                    "severity": incident["properties"]["severity"],
+                    "classification": close_reason[0],
+                    "classificationComment": kwargs["close_comment"],
+                },
+            }
+            if len(close_reason) > 1:
+                close_data["properties"]["classificationReason"] = close_reason[1]
+
+            res = await self._call("PUT", incident_url, json=close_data, params=API_PARAMS)
+            if res.status_code != 412:
+                break
+
+            # The etag is stale, fetch the current incident and try once more
+            self.logger.info("Incident %s changed, retrying close", kwargs["incident_id"])
+            incident = None
+
+        if res.status_code not in SUCCESS_STATUSES:
+            return json.dumps(api_error(res))
+
+        return mark_success(res)
 
     async def add_comment(self, **kwargs):
 
         # Get a client credential access token
-        auth = await self.authenticate(
-            kwargs["tenant_id"], kwargs["client_id"], kwargs["client_secret"]
-        )
+        auth = await self._ensure_auth(**kwargs)
         if not auth["success"]:
-            return {"error": auth["message"]}
+            return json.dumps({"success": False, "error": auth["message"]})
 
-        comment_url = f"{self.azure_url}/subscriptions/{kwargs['subscription_id']}/resourceGroups/{kwargs['resource_group_name']}/providers/Microsoft.OperationalInsights/workspaces/{kwargs['workspace_name']}/providers/Microsoft.SecurityInsights/incidents/{kwargs['incident_id']}/comments"
-        params = {"api-version": "2020-01-01"}
-
-        comment_id = str(uuid.uuid4())
+        comment_url = f"{self._workspace_url(kwargs)}/incidents/{kwargs['incident_id']}/comments/{uuid.uuid4()}"
         comment_data = {"properties": {"message": kwargs["comment"]}}
 
-        res = self.s.put(f"{comment_url}/{comment_id}", json=comment_data, params=params)
-        if res.status_code != 200:
-            return res.text
-
-        result = res.json()
-        result["success"] = True
+        res = await self._call("PUT", comment_url, json=comment_data, params=API_PARAMS)
+        if res.status_code not in SUCCESS_STATUSES:
+            return json.dumps(api_error(res))
 
-        return json.dumps(result)
+        return mark_success(res)
 
 
 if __name__ == "__main__":